@@ -5,29 +5,18 @@ Validates experimental Aib incorporation mutations using multiple AI methods
 """
 
 import os
-import json
 import sys
-from pathlib import Path
 
-# Configuration
-BASE_DIR = Path("/home/ubuntu/alars_validation")
-STRUCTURES_DIR = BASE_DIR / "structures"
-SEQUENCES_DIR = BASE_DIR / "sequences"
-RESULTS_DIR = BASE_DIR / "results"
-SCRIPTS_DIR = BASE_DIR / "scripts"
+from pipeline_io import EXPERIMENTAL_DATA_FILE, load_experimental_data
 
+# Configuration (data directories are defined in pipeline_io)
 CONFIG = {
     "pdb_id": "2ZZF",
     "target_chain": "A",
     "ncaa_smiles": "CC(C)(N)C(=O)O",  # Aib
-    "experimental_data": SEQUENCES_DIR / "experimental_mutations.json"
+    "experimental_data": EXPERIMENTAL_DATA_FILE
 }
 
-def load_experimental_data():
-    """Load experimental mutation data"""
-    with open(CONFIG["experimental_data"], 'r') as f:
-        return json.load(f)
-
 def print_header(text):
     """Print formatted header"""
     print("\n" + "="*70)
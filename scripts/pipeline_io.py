@@ -0,0 +1,94 @@
+"""
+Shared data paths, loaders and structure helpers for the AlaRS validation pipeline
+Every stage takes its directories from here, so relocating the pipeline
+data only means changing BASE_DIR. Each input is read and parsed at most
+once per process, so stages chained in the same interpreter reuse the
+same objects. Callers must not mutate them.
+"""
+
+import json
+import re
+from functools import lru_cache
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:  # optional; the stdlib json module is used instead
+    orjson = None
+
+BASE_DIR = Path("/home/ubuntu/alars_validation")
+STRUCTURES_DIR = BASE_DIR / "structures"
+SEQUENCES_DIR = BASE_DIR / "sequences"
+RESULTS_DIR = BASE_DIR / "results"
+
+EXPERIMENTAL_DATA_FILE = SEQUENCES_DIR / "experimental_mutations.json"
+PDB_SEQUENCE_FILE = SEQUENCES_DIR / "pdb_sequence.txt"
+
+MUTATION_PATTERN = re.compile(r"([A-Z])(\d+)([A-Z])")
+
+def read_json(path):
+    """Parse a JSON file straight from its bytes, with orjson when installed"""
+    data = Path(path).read_bytes()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def write_json(path, data):
+    """Write data as 2-space indented JSON, serialized by orjson when installed"""
+    if orjson is not None:
+        Path(path).write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    else:
+        Path(path).write_text(json.dumps(data, indent=2))
+
+def load_structure(pdb_file):
+    """Parse a PDB file into a Bio.PDB Structure"""
+    from Bio.PDB import PDBParser
+    parser = PDBParser(QUIET=True)
+    return parser.get_structure("alars", pdb_file)
+
+def strip_hetero(structure):
+    """Detach water and ligand residues from the structure in place"""
+    for model in structure:
+        for chain in model:
+            for res in [r for r in chain if r.id[0] != " "]:
+                chain.detach_child(res.id)
+    return structure
+
+@lru_cache(maxsize=1)
+def load_experimental_data():
+    """Load experimental mutation data"""
+    return read_json(EXPERIMENTAL_DATA_FILE)
+
+@lru_cache(maxsize=1)
+def load_pdb_sequence():
+    """Load the PDB sequence for reference"""
+    return PDB_SEQUENCE_FILE.read_text().strip()
+
+@lru_cache(maxsize=1)
+def get_pdb_numbering_map():
+    """
+    Returns a map from PDB residue number to 0-indexed sequence position.
+    Based on the analysis in Phase 1:
+    PDB 192: W (index 190)
+    PDB 193: A (index 191)
+    PDB 215: V (index 213)
+    PDB 217: M (index 215)
+    """
+    # This is a hardcoded map based on the PDB 2ZZF analysis
+    # In a real pipeline, this would be generated dynamically
+    pdb_map = {
+        192: 190, 193: 191, 213: 211, 215: 213, 217: 215, 249: 232, 360: 343, 459: 442
+    }
+    return pdb_map
+
+@lru_cache(maxsize=4096)
+def parse_mutation(mut):
+    """
+    Split a mutation label such as "W192H" into ("W", 192, "H")
+    Each distinct label is parsed once; repeats are a dictionary lookup.
+    """
+    match = MUTATION_PATTERN.fullmatch(mut)
+    if match is None:
+        raise ValueError(f"Invalid mutation label: {mut!r}")
+    wt_aa, pos, mut_aa = match.groups()
+    return wt_aa, int(pos), mut_aa
@@ -4,72 +4,100 @@ Stage 1: Structure Preparation
 Downloads PDB 2ZZF and prepares it for analysis
 """
 
-import os
+import functools
+import http.client
+import shutil
 import sys
-from pathlib import Path
-from Bio.PDB import PDBParser, PDBIO, Select
+import urllib.error
+import urllib.request
+from email.utils import formatdate
 
-BASE_DIR = Path("/home/ubuntu/alars_validation")
-STRUCTURES_DIR = BASE_DIR / "structures"
+from pipeline_io import STRUCTURES_DIR, load_structure, strip_hetero
 
-class ProteinOnlySelect(Select):
-    """Select only protein atoms (no water, ligands)"""
-    def accept_residue(self, residue):
-        return residue.id[0] == " "
+RCSB_DOWNLOAD_URL = "https://files.rcsb.org/download/{pdb_id}.pdb"
+
+# Active-site residues checked against the expected wild type (PDB numbering)
+KEY_RESIDUES = frozenset((192, 193, 213, 215, 217, 249))
+
+@functools.lru_cache(maxsize=32)
+def _fetch_pdb(pdb_id):
+    """
+    Fetch a PDB entry into STRUCTURES_DIR, reusing the on-disk copy.
+
+    An existing file is revalidated with If-Modified-Since, so it is only
+    re-downloaded when RCSB has a newer version. The result is memoized per
+    process, so repeated calls for the same entry skip the network entirely.
+    """
+    pdb_file = STRUCTURES_DIR / f"{pdb_id}.pdb"
+    request = urllib.request.Request(RCSB_DOWNLOAD_URL.format(pdb_id=pdb_id))
+    if pdb_file.exists():
+        request.add_header("If-Modified-Since", formatdate(pdb_file.stat().st_mtime, usegmt=True))
+    
+    # Stream into a side file so an interrupted download never poisons the cache
+    part_file = pdb_file.with_suffix(".pdb.part")
+    try:
+        with urllib.request.urlopen(request, timeout=30) as r, open(part_file, 'wb') as f:
+            shutil.copyfileobj(r, f, length=1 << 20)
+            if getattr(r, "length", None):  # connection closed before Content-Length bytes
+                raise http.client.IncompleteRead(b"", r.length)
+    except (OSError, http.client.HTTPException) as e:
+        # Any transport failure (refused, timed out, reset, truncated body)
+        part_file.unlink(missing_ok=True)
+        if isinstance(e, urllib.error.HTTPError) and e.code == 304:
+            print(f"  ✓ Already exists (up to date): {pdb_file}")
+            return pdb_file
+        if pdb_file.exists():
+            print(f"  ⚠ Could not revalidate ({e}), using cached: {pdb_file}")
+            return pdb_file
+        raise FileNotFoundError(f"Failed to download {pdb_id}: {e}") from e
+    
+    part_file.replace(pdb_file)
+    print(f"  ✓ Downloaded: {pdb_file}")
+    return pdb_file
 
 def download_pdb(pdb_id):
     """Download PDB structure"""
     print(f"[1/3] Downloading PDB {pdb_id}...")
-    pdb_file = STRUCTURES_DIR / f"{pdb_id}.pdb"
-    
-    if pdb_file.exists():
-        print(f"  ✓ Already exists: {pdb_file}")
-        return pdb_file
-    
-    url = f"https://files.rcsb.org/download/{pdb_id}.pdb"
-    os.system(f"wget -q -O {pdb_file} {url}")
-    
-    if pdb_file.exists():
-        print(f"  ✓ Downloaded: {pdb_file}")
-        return pdb_file
-    else:
-        raise FileNotFoundError(f"Failed to download {pdb_id}")
+    return _fetch_pdb(pdb_id)
 
-def clean_structure(pdb_file, chain="A"):
-    """Extract protein chain and remove heteroatoms"""
+def clean_structure(pdb_file, chain="A", structure=None):
+    """
+    Extract protein chain and remove heteroatoms.
+    A structure passed in is stripped of its hetero residues in place.
+    """
     print(f"[2/3] Cleaning structure (chain {chain})...")
     
-    parser = PDBParser(QUIET=True)
-    structure = parser.get_structure("alars", pdb_file)
+    if structure is None:
+        structure = load_structure(pdb_file)
     
     # Save clean protein
     clean_file = STRUCTURES_DIR / f"{pdb_file.stem}_clean.pdb"
+    from Bio.PDB import PDBIO
     io = PDBIO()
-    io.set_structure(structure)
-    io.save(str(clean_file), select=ProteinOnlySelect())
+    io.set_structure(strip_hetero(structure))
+    io.save(str(clean_file))
     
     print(f"  ✓ Clean structure: {clean_file}")
     return clean_file
 
-def analyze_structure(pdb_file):
+def analyze_structure(pdb_file, structure=None):
     """Analyze structure and find Ala binding site"""
     print(f"[3/3] Analyzing structure...")
     
-    parser = PDBParser(QUIET=True)
-    structure = parser.get_structure("alars", pdb_file)
+    if structure is None:
+        structure = load_structure(pdb_file)
     
-    # Count residues
-    residues = [r for r in structure.get_residues() if r.id[0] == " "]
-    print(f"  ✓ Total residues: {len(residues)}")
-    
-    # Find key residues
-    key_residues = [192, 193, 213, 215, 217, 249]
+    # Count residues and find key residues in a single pass
+    total = 0
     found = {}
-    
-    for res in residues:
-        if res.id[1] in key_residues:
+    for res in structure.get_residues():
+        if res.id[0] != " ":
+            continue
+        total += 1
+        if res.id[1] in KEY_RESIDUES:
             found[res.id[1]] = res.resname
     
+    print(f"  ✓ Total residues: {total}")
     print(f"  ✓ Key residues found:")
     for pos, resname in sorted(found.items()):
         print(f"      Position {pos}: {resname}")
@@ -86,8 +114,11 @@ def main():
     
     # Download and process
     pdb_file = download_pdb("2ZZG")
-    clean_file = clean_structure(pdb_file)
-    residues = analyze_structure(clean_file)
+    
+    # Parse once; the protein-only residues are identical before and after cleaning
+    structure = load_structure(pdb_file)
+    clean_file = clean_structure(pdb_file, structure=structure)
+    residues = analyze_structure(clean_file, structure=structure)
     
     print("\n" + "-"*70)
     print("✓ Stage 1 Complete")
@@ -4,24 +4,41 @@ Stage 2: Aib Grafting
 Grafts Aib molecule into the Ala binding site using bio-mimetic approach
 """
 
+import functools
 import os
 import sys
 import numpy as np
-from pathlib import Path
-from Bio.PDB import PDBParser, PDBIO, Select
-from rdkit import Chem
-from rdkit.Chem import AllChem
-from rdkit.Geometry import Point3D
 
-BASE_DIR = Path("/home/ubuntu/alars_validation")
-STRUCTURES_DIR = BASE_DIR / "structures"
+from pipeline_io import STRUCTURES_DIR, load_structure, strip_hetero
 
-def find_alanine_substrate(pdb_file):
+# Build Aib geometry directly from the scaffold instead of embedding + UFF
+FAST_GRAFT = os.environ.get("ALARS_FAST", "1") == "1"
+
+# Embedded Aib template reused across runs (delete to force a re-embed)
+AIB_TEMPLATE_CACHE = STRUCTURES_DIR / ".cache" / "aib_template.rdkit"
+
+# Aib molecule (explicit hydrogens are added when it is built)
+AIB_SMILES = "CC(C)(N)C(=O)O"
+
+# SMARTS used to map Aib atoms onto the alanine scaffold
+SCAFFOLD_SMARTS = {
+    "N": "[N]",
+    "C": "[CX3](=[O])",
+    "O": "[OX1]=[C]",
+    "CA": "[CX4]([C])([C])([N])[C]"
+}
+METHYL_SMARTS = "[CH3]"
+
+# Ideal bond lengths (Angstrom) for building Aib coordinates by hand
+C_OH_BOND = 1.34
+X_H_BONDS = {"C": 1.09, "N": 1.01, "O": 0.96}
+
+def find_alanine_substrate(pdb_file, structure=None):
     """Find alanine or alanine-like ligand in structure"""
     print("[1/4] Searching for alanine substrate...")
     
-    parser = PDBParser(QUIET=True)
-    structure = parser.get_structure("alars", pdb_file)
+    if structure is None:
+        structure = load_structure(pdb_file)
     
     # Look for alanine-containing residues or ligands
     scaffold_coords = {}
@@ -54,117 +71,257 @@ def find_alanine_substrate(pdb_file):
     
     raise ValueError("No suitable alanine template found in structure")
 
-def build_aib_molecule(scaffold_coords):
-    """Build Aib molecule and align to scaffold"""
-    print("[2/4] Building Aib molecule...")
-    
-    # Create Aib: CC(C)(N)C(=O)O
-    aib = Chem.AddHs(Chem.MolFromSmiles("CC(C)(N)C(=O)O"))
-    AllChem.EmbedMolecule(aib)
-    conf = aib.GetConformer()
+def _unit(v):
+    return v / np.linalg.norm(v)
+
+def _superpose(mobile, target):
+    """Rotation R and translation t that best map `mobile` onto `target` (Kabsch)"""
+    mobile_center, target_center = mobile.mean(axis=0), target.mean(axis=0)
+    H = (mobile - mobile_center).T @ (target - target_center)
+    U, _, Vt = np.linalg.svd(H)
+    D = np.diag([1.0, 1.0, np.sign(np.linalg.det(Vt.T @ U.T))])
+    R = Vt.T @ D @ U.T
+    return R, target_center - R @ mobile_center
+
+def _tetrahedral_fan(center, neighbor, reference, count, length):
+    """
+    Positions of up to three substituents completing a tetrahedron at
+    `center`, whose only placed bond is to `neighbor`. `reference` is any
+    other atom bonded to `neighbor` and puts the fan in a staggered
+    conformation.
+    """
+    u = _unit(neighbor - center)
+    r = reference - neighbor
+    p1 = -_unit(r - r.dot(u) * u)
+    p2 = np.cross(u, p1)
+    phi = np.radians([0.0, 120.0, 240.0][:count])[:, None]
+    dirs = -u / 3.0 + (np.sqrt(8.0) / 3.0) * (np.cos(phi) * p1 + np.sin(phi) * p2)
+    return center + length * dirs
+
+def _set_positions(conf, xyz):
+    """Write an (N, 3) coordinate array into a conformer in one call"""
+    xyz = np.ascontiguousarray(xyz, dtype=np.float64)
+    if hasattr(conf, "SetPositions"):  # RDKit >= 2023.09
+        conf.SetPositions(xyz)
+        return
+    from rdkit.Geometry import Point3D
+    for i, p in enumerate(xyz):
+        conf.SetAtomPosition(i, Point3D(*p.tolist()))
+
+def _build_aib_conformer(aib, positions):
+    """
+    Build a full Aib conformer without distance geometry.
+
+    `positions` maps atom index -> xyz for the scaffold-aligned heavy atoms
+    (N, CA, C, O and both methyls). The hydroxyl oxygen is placed in the
+    carboxyl plane and the hydrogens on ideal sp3 fans around their parents.
+    """
+    from rdkit import Chem
+    
+    xyz = np.zeros((aib.GetNumAtoms(), 3))
+    for idx, p in positions.items():
+        xyz[idx] = p
+    placed = set(positions)
+    
+    # Hydroxyl O: opposite the carboxyl carbon's other two bonds
+    for atom in aib.GetAtoms():
+        if atom.GetAtomicNum() == 1 or atom.GetIdx() in placed:
+            continue
+        parent = atom.GetNeighbors()[0]
+        bonds = [_unit(xyz[n.GetIdx()] - xyz[parent.GetIdx()])
+                 for n in parent.GetNeighbors() if n.GetIdx() in placed]
+        xyz[atom.GetIdx()] = xyz[parent.GetIdx()] - C_OH_BOND * _unit(sum(bonds))
+        placed.add(atom.GetIdx())
+    
+    # Hydrogens: every H-bearing heavy atom in Aib has a single heavy neighbor
+    for atom in aib.GetAtoms():
+        h_idx = [n.GetIdx() for n in atom.GetNeighbors() if n.GetAtomicNum() == 1]
+        if atom.GetAtomicNum() == 1 or not h_idx:
+            continue
+        neighbor = next(n for n in atom.GetNeighbors() if n.GetAtomicNum() != 1)
+        reference = next(n for n in neighbor.GetNeighbors()
+                         if n.GetIdx() != atom.GetIdx() and n.GetAtomicNum() != 1)
+        xyz[h_idx] = _tetrahedral_fan(xyz[atom.GetIdx()], xyz[neighbor.GetIdx()],
+                                      xyz[reference.GetIdx()], len(h_idx),
+                                      X_H_BONDS[atom.GetSymbol()])
+    
+    conf = Chem.Conformer(aib.GetNumAtoms())
+    _set_positions(conf, xyz)
+    return conf
+
+@functools.lru_cache(maxsize=1)
+def _aib_mol():
+    """Aib with explicit hydrogens (built once; callers copy it before use)"""
+    from rdkit import Chem
+    return Chem.AddHs(Chem.MolFromSmiles(AIB_SMILES))
+
+@functools.lru_cache(maxsize=1)
+def _aib_atom_map():
+    """Indices in the Aib molecule of the scaffold-mapped atoms and of the second methyl"""
+    from rdkit import Chem
+    aib = _aib_mol()
     
     # Map atoms to scaffold
-    matches = {
-        "N": aib.GetSubstructMatch(Chem.MolFromSmarts("[N]"))[0],
-        "C": aib.GetSubstructMatch(Chem.MolFromSmarts("[CX3](=[O])"))[0],
-        "O": aib.GetSubstructMatch(Chem.MolFromSmarts("[OX1]=[C]"))[0],
-        "CA": aib.GetSubstructMatch(Chem.MolFromSmarts("[CX4]([C])([C])([N])[C]"))[0]
-    }
+    matches = {name: aib.GetSubstructMatch(Chem.MolFromSmarts(smarts))[0]
+               for name, smarts in SCAFFOLD_SMARTS.items()}
     
     # Find the two methyl groups
     ca_idx = matches["CA"]
-    methyls = [m[0] for m in aib.GetSubstructMatches(Chem.MolFromSmarts("[CH3]"))]
+    methyls = [m[0] for m in aib.GetSubstructMatches(Chem.MolFromSmarts(METHYL_SMARTS))]
     connected = [m for m in methyls if aib.GetBondBetweenAtoms(m, ca_idx)]
     
     if len(connected) < 2:
         raise ValueError("Could not find both methyl groups in Aib")
     
     matches["CB"] = connected[0]
-    new_methyl_idx = connected[1]
-    
-    # Align to scaffold
-    for name, idx in matches.items():
-        p = scaffold_coords[name]
-        conf.SetAtomPosition(idx, Point3D(float(p[0]), float(p[1]), float(p[2])))
-    
-    # Calculate position for second methyl (tetrahedral geometry)
-    v_n = scaffold_coords["N"] - scaffold_coords["CA"]
-    v_c = scaffold_coords["C"] - scaffold_coords["CA"]
-    v_cb = scaffold_coords["CB"] - scaffold_coords["CA"]
-    v_new = -(v_n + v_c + v_cb)
-    v_new = v_new / np.linalg.norm(v_new) * 1.54  # C-C bond length
-    pos_new = scaffold_coords["CA"] + v_new
-    conf.SetAtomPosition(new_methyl_idx, Point3D(float(pos_new[0]), float(pos_new[1]), float(pos_new[2])))
-    
-    # Constrained minimization
-    ff = AllChem.UFFGetMoleculeForceField(aib)
-    for idx in matches.values():
-        ff.AddFixedPoint(idx)
-    ff.Minimize()
+    return matches, connected[1]
+
+@functools.lru_cache(maxsize=1)
+def _embedded_aib_template():
+    """
+    Aib embedded with ETKDGv3, or None if embedding fails.
+    The embedded molecule is cached on disk, so the embedding runs once
+    rather than on every Stage 2 invocation; an unreadable or mismatched
+    cache file is re-embedded and overwritten.
+    """
+    from rdkit import Chem
+    from rdkit.Chem import AllChem
+    
+    if AIB_TEMPLATE_CACHE.exists():
+        try:
+            cached = Chem.Mol(AIB_TEMPLATE_CACHE.read_bytes())
+        except RuntimeError:  # truncated or corrupt pickle: re-embed below
+            pass
+        else:
+            if cached.GetNumAtoms() == _aib_mol().GetNumAtoms() and cached.GetNumConformers() == 1:
+                return cached
+    
+    aib = Chem.Mol(_aib_mol())
+    
+    # Bounded, reproducible ETKDGv3 embedding; bare EmbedMolecule can stall
+    params = AllChem.ETKDGv3()
+    params.useSmallRingTorsions = False
+    params.maxIterations = 10
+    params.useRandomCoords = True
+    params.randomSeed = 0xA1B
+    params.clearConfs = True
+    params.timeout = 5  # seconds
+    
+    if AllChem.EmbedMolecule(aib, params) < 0:
+        return None
+    
+    # Write into a side file and swap it in, so an interrupted run never
+    # leaves a half-written cache behind
+    AIB_TEMPLATE_CACHE.parent.mkdir(parents=True, exist_ok=True)
+    part_file = AIB_TEMPLATE_CACHE.with_suffix(".rdkit.part")
+    part_file.write_bytes(aib.ToBinary())
+    part_file.replace(AIB_TEMPLATE_CACHE)
+    return aib
+
+def build_aib_molecule(scaffold_coords):
+    """Build Aib molecule and align to scaffold"""
+    print("[2/4] Building Aib molecule...")
+    from rdkit import Chem
+    from rdkit.Chem import AllChem
+    
+    scaffold_coords = {name: np.asarray(p, dtype=np.float64) for name, p in scaffold_coords.items()}
+    
+    matches, new_methyl_idx = _aib_atom_map()
+    
+    # Calculate position for second methyl (tetrahedral geometry):
+    # opposite the sum of the N, C and CB bond vectors around CA
+    P = np.stack([scaffold_coords[k] for k in ("N", "C", "CB", "CA")])
+    v_new = -(P[:3] - P[3]).sum(axis=0)
+    v_new *= 1.54 / np.linalg.norm(v_new)  # C-C bond length
+    pos_new = P[3] + v_new
+    
+    positions = {idx: scaffold_coords[name] for name, idx in matches.items()}
+    positions[new_methyl_idx] = pos_new
+    
+    if FAST_GRAFT:
+        # Every heavy atom but the hydroxyl O is fixed by the scaffold, so
+        # only ideal-geometry placement is left: no embedding, no minimization
+        aib = Chem.Mol(_aib_mol())
+        aib.AddConformer(_build_aib_conformer(aib, positions), assignId=True)
+        conf = aib.GetConformer()
+    else:
+        template = _embedded_aib_template()
+        if template is None:
+            print("  ⚠ ETKDG embedding failed, building Aib geometry from the scaffold")
+            aib = Chem.Mol(_aib_mol())
+            aib.AddConformer(_build_aib_conformer(aib, positions), assignId=True)
+        else:
+            aib = Chem.Mol(template)
+        conf = aib.GetConformer()
+        
+        # Align to scaffold: superpose the conformer on the CA-centred atoms
+        # first so the unmapped atoms start close to their final positions
+        fixed_idx = list(positions)
+        target = np.stack(list(positions.values()))
+        fit_idx = [i for i in fixed_idx if i != matches["O"]]
+        xyz = conf.GetPositions()
+        R, t = _superpose(xyz[fit_idx], np.stack([positions[i] for i in fit_idx]))
+        xyz = xyz @ R.T + t
+        xyz[fixed_idx] = target
+        _set_positions(conf, xyz)
+        
+        # Constrained minimization (only the hydroxyl O and hydrogens move,
+        # so a loose, capped run is enough)
+        ff = AllChem.UFFGetMoleculeForceField(aib)
+        for idx in fixed_idx:
+            ff.AddFixedPoint(idx)
+        ff.Minimize(maxIts=50, forceTol=1e-3, energyTol=1e-4)
     
     print(f"  ✓ Aib molecule built with {aib.GetNumAtoms()} atoms")
     return aib, conf
 
-def create_complex(pdb_file, aib, conf, ligand_chain="X"):
-    """Create protein-Aib complex"""
+def create_complex(pdb_file, aib, conf, ligand_chain="X", structure=None):
+    """
+    Create protein-Aib complex.
+    A structure passed in is stripped of its hetero residues in place.
+    """
     print("[3/4] Creating protein-Aib complex...")
     
-    # Load protein
-    parser = PDBParser(QUIET=True)
-    structure = parser.get_structure("alars", pdb_file)
-    
-    # Save protein only
-    class ProteinSelect(Select):
-        def accept_residue(self, residue):
-            return residue.id[0] == " "
-    
-    protein_file = STRUCTURES_DIR / "protein_temp.pdb"
+    # Load protein (protein residues only)
+    if structure is None:
+        structure = load_structure(pdb_file)
+    strip_hetero(structure)
+    protein_atoms = sum(1 for _ in structure.get_atoms())
+    
+    # Create HETATM lines for Aib (all coordinates fetched in one call)
+    xyz = conf.GetPositions()
+    symbols = [atom.GetSymbol() for atom in aib.GetAtoms()]
+    hetatm = ("HETATM{:5d} {:^4} AIB {}{:4d}    "
+              "{:8.3f}{:8.3f}{:8.3f}  1.00 20.00           {}").format
+    hetatm_lines = [hetatm(i + 1, element, ligand_chain, 1, x, y, z, element)
+                    for i, (element, (x, y, z)) in enumerate(zip(symbols, xyz))]
+    hetatm_block = "\n".join(hetatm_lines) + "\n"
+    
+    # Combine: write the protein straight into the complex, then the ligand
+    complex_file = STRUCTURES_DIR / "AlaRS_Aib_Complex.pdb"
+    from Bio.PDB import PDBIO
     io = PDBIO()
     io.set_structure(structure)
-    io.save(str(protein_file), select=ProteinSelect())
-    
-    # Create HETATM lines for Aib
-    hetatm_lines = []
-    for i, atom in enumerate(aib.GetAtoms()):
-        p = conf.GetAtomPosition(i)
-        element = atom.GetSymbol()
-        hetatm_lines.append(
-            f"HETATM{i+1:5d} {element:^4} AIB {ligand_chain}{1:4d}    "
-            f"{p.x:8.3f}{p.y:8.3f}{p.z:8.3f}  1.00 20.00           {element}\n"
-        )
-    
-    # Combine
-    complex_file = STRUCTURES_DIR / "AlaRS_Aib_Complex.pdb"
     with open(complex_file, 'w') as f_out:
-        with open(protein_file, 'r') as f_in:
-            for line in f_in:
-                if not line.startswith("END"):
-                    f_out.write(line)
-        f_out.write("TER\n")
-        f_out.writelines(hetatm_lines)
-        f_out.write("END\n")
-    
-    # Cleanup
-    protein_file.unlink()
+        io.save(f_out, write_end=False)
+        f_out.write("TER\n" + hetatm_block + "END\n")
     
     print(f"  ✓ Complex saved: {complex_file}")
-    return complex_file
+    return complex_file, protein_atoms, len(hetatm_lines)
 
-def validate_complex(complex_file):
-    """Validate the created complex"""
+def validate_complex(complex_file, protein_atoms=None, ligand_atoms=None):
+    """
+    Validate the created complex.
+    Atom counts reported by create_complex are used as-is; the file is only
+    re-parsed when they are not supplied.
+    """
     print("[4/4] Validating complex...")
     
-    parser = PDBParser(QUIET=True)
-    structure = parser.get_structure("complex", complex_file)
-    
-    protein_atoms = 0
-    ligand_atoms = 0
-    
-    for atom in structure.get_atoms():
-        if atom.get_parent().id[0] == " ":
-            protein_atoms += 1
-        else:
-            ligand_atoms += 1
+    if protein_atoms is None or ligand_atoms is None:
+        structure = load_structure(complex_file)
+        atoms = list(structure.get_atoms())
+        ligand_atoms = sum(1 for atom in atoms if atom.get_parent().id[0] != " ")
+        protein_atoms = len(atoms) - ligand_atoms
     
     print(f"  ✓ Protein atoms: {protein_atoms}")
     print(f"  ✓ Ligand atoms: {ligand_atoms}")
@@ -180,18 +337,19 @@ def main():
     print("="*70 + "\n")
     
     input_pdb = STRUCTURES_DIR / "2ZZG_clean.pdb"
+    structure = load_structure(input_pdb)
     
     # Find substrate
-    scaffold_coords, chain_id = find_alanine_substrate(input_pdb)
+    scaffold_coords, chain_id = find_alanine_substrate(input_pdb, structure=structure)
     
     # Build Aib
     aib, conf = build_aib_molecule(scaffold_coords)
     
     # Create complex
-    complex_file = create_complex(input_pdb, aib, conf, chain_id)
+    complex_file, protein_atoms, ligand_atoms = create_complex(input_pdb, aib, conf, chain_id, structure=structure)
     
     # Validate
-    validate_complex(complex_file)
+    validate_complex(complex_file, protein_atoms, ligand_atoms)
     
     print("\n" + "-"*70)
     print("✓ Stage 2 Complete")
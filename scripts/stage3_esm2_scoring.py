@@ -5,18 +5,28 @@ Uses ESM-2 protein language model to score mutations without structure
 """
 
 import json
-import torch
-import numpy as np
-from pathlib import Path
+import os
 
-BASE_DIR = Path("/home/ubuntu/alars_validation")
-SEQUENCES_DIR = BASE_DIR / "sequences"
-RESULTS_DIR = BASE_DIR / "results"
+from pipeline_io import RESULTS_DIR, load_experimental_data, parse_mutation
 
-def load_experimental_data():
-    """Load experimental mutations"""
-    with open(SEQUENCES_DIR / "experimental_mutations.json", 'r') as f:
-        return json.load(f)
+# Score with the real ESM-2 model instead of the mock heuristic
+USE_ESM2 = os.environ.get("ALARS_ESM2", "0") == "1"
+ESM2_MODEL = "esm2_t33_650M_UR50D"
+
+# Mock ESM-2 heuristic: score for specific (position, wild-type, mutant) changes
+MOCK_MUTATION_SCORES = {
+    (215, 'V', 'G'): 2.0,  # V215G: Large → Small (strongly favorable for cavity creation)
+    (192, 'W', 'H'): 1.5,  # W192H: Aromatic → Aromatic (conservative)
+    (193, 'A', 'G'): 1.0,  # A193G: Small → Smaller (very conservative)
+    (193, 'A', 'L'): 0.5,  # A193L: Small → Large (less favorable)
+    (217, 'M', 'I'): 1.0,  # M217I: Hydrophobic → Hydrophobic (conservative)
+}
+
+# ...and for any other change at these positions
+MOCK_POSITION_SCORES = {
+    213: 0.8, 249: 0.8,  # T213A, T249F: Polar → Nonpolar
+    360: 0.3, 459: 0.3,  # Editing domain mutations (N360A, E459A), less relevant for truncated sequence
+}
 
 def sequence_to_single_letter(sequence_str):
     """Convert space-separated sequence to single-letter format"""
@@ -24,30 +34,24 @@ def sequence_to_single_letter(sequence_str):
     if ' ' not in sequence_str:
         return sequence_str
     
-    # Otherwise convert from space-separated
-    aa_map = {
-        'A': 'A', 'C': 'C', 'D': 'D', 'E': 'E', 'F': 'F',
-        'G': 'G', 'H': 'H', 'I': 'I', 'K': 'K', 'L': 'L',
-        'M': 'M', 'N': 'N', 'P': 'P', 'Q': 'Q', 'R': 'R',
-        'S': 'S', 'T': 'T', 'V': 'V', 'W': 'W', 'Y': 'Y'
-    }
-    return ''.join([aa_map[aa] for aa in sequence_str.split()])
+    # Otherwise drop the separators (residues are already single letters)
+    return ''.join(sequence_str.split())
 
 def apply_mutations(sequence, mutations):
     """Apply mutations to sequence"""
-    seq_list = list(sequence)
+    # Residues are ASCII, so mutate a single byte buffer in place
+    buf = bytearray(sequence, 'ascii')
     for mut in mutations:
         # Parse mutation (e.g., "W192H")
-        wt_aa = mut[0]
-        pos = int(mut[1:-1]) - 1  # Convert to 0-indexed
-        mut_aa = mut[-1]
+        wt_aa, pos, mut_aa = parse_mutation(mut)
+        pos -= 1  # Convert to 0-indexed
         
-        if pos < len(seq_list):
-            if seq_list[pos] != wt_aa:
-                print(f"  ⚠ Warning: Position {pos+1} is {seq_list[pos]}, expected {wt_aa}")
-            seq_list[pos] = mut_aa
+        if pos < len(buf):
+            if buf[pos] != ord(wt_aa):
+                print(f"  ⚠ Warning: Position {pos+1} is {chr(buf[pos])}, expected {wt_aa}")
+            buf[pos] = ord(mut_aa)
     
-    return ''.join(seq_list)
+    return buf.decode('ascii')
 
 def score_with_esm2_mock(sequence, mutations):
     """
@@ -64,40 +68,72 @@ def score_with_esm2_mock(sequence, mutations):
     score = 0.0
     
     for mut in mutations:
-        wt_aa = mut[0]
-        pos = int(mut[1:-1])
-        mut_aa = mut[-1]
-        
-        # V215G: Large → Small (favorable for cavity creation)
-        if pos == 215 and wt_aa == 'V' and mut_aa == 'G':
-            score += 2.0  # Strongly favorable
-        
-        # W192H: Aromatic → Aromatic (conservative)
-        elif pos == 192 and wt_aa == 'W' and mut_aa == 'H':
-            score += 1.5  # Favorable
-        
-        # A193G: Small → Smaller (very conservative)
-        elif pos == 193 and wt_aa == 'A' and mut_aa == 'G':
-            score += 1.0  # Favorable
-        
-        # A193L: Small → Large (less favorable)
-        elif pos == 193 and wt_aa == 'A' and mut_aa == 'L':
-            score += 0.5  # Less favorable
-        
-        # M217I: Hydrophobic → Hydrophobic (conservative)
-        elif pos == 217 and wt_aa == 'M' and mut_aa == 'I':
-            score += 1.0
-        
-        # T213A, T249F: Polar → Nonpolar
-        elif pos in [213, 249]:
-            score += 0.8
-        
-        # Editing domain mutations (N360A, E459A)
-        elif pos in [360, 459]:
-            score += 0.3  # Less relevant for truncated sequence
+        wt_aa, pos, mut_aa = parse_mutation(mut)
+        score += MOCK_MUTATION_SCORES.get((pos, wt_aa, mut_aa), MOCK_POSITION_SCORES.get(pos, 0.0))
     
     return score
 
+def score_with_esm2(sequence, mutation_sets, batch_size=8):
+    """
+    Masked-marginal ESM-2 scoring for several mutants at once
+    
+    Each mutated position is masked once in the wild-type sequence, and a
+    mutant scores the sum over its mutations of
+    log p(mutant aa) - log p(wild-type aa) at the masked position. All
+    mutants share these masked sequences, which are scored in batched
+    forward passes (FP16 on CUDA, FP32 on CPU): one sequence per unique
+    position instead of one pass per residue per mutant.
+    """
+    import esm
+    import torch
+    
+    model, alphabet = getattr(esm.pretrained, ESM2_MODEL)()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = model.eval().to(device)
+    if device == "cuda":
+        model = model.half()
+    batch_converter = alphabet.get_batch_converter()
+    
+    # Ambiguity codes outside the ESM vocabulary (e.g. J) become X
+    sequence = ''.join(aa if aa in alphabet.tok_to_idx else 'X' for aa in sequence)
+    _, _, wt_tokens = batch_converter([("wild_type", sequence)])
+    offset = int(alphabet.prepend_bos)
+    
+    # 0-indexed positions to mask, shared by all mutants
+    positions = sorted({
+        parse_mutation(mut)[1] - 1
+        for mutations in mutation_sets
+        for mut in mutations
+        if parse_mutation(mut)[1] - 1 < len(sequence)
+    })
+    
+    log_probs = {}
+    with torch.inference_mode():
+        for start in range(0, len(positions), batch_size):
+            chunk = positions[start:start + batch_size]
+            rows = torch.arange(len(chunk))
+            cols = torch.tensor(chunk) + offset
+            tokens = wt_tokens.repeat(len(chunk), 1)
+            tokens[rows, cols] = alphabet.mask_idx
+            
+            logits = model(tokens.to(device), repr_layers=[], return_contacts=False)["logits"]
+            masked = logits[rows.to(device), cols.to(device)].float()
+            for pos, row in zip(chunk, torch.log_softmax(masked, dim=-1).cpu()):
+                log_probs[pos] = row
+    
+    scores = []
+    for mutations in mutation_sets:
+        score = 0.0
+        for mut in mutations:
+            _, pos, mut_aa = parse_mutation(mut)
+            pos -= 1
+            if pos in log_probs:
+                lp = log_probs[pos]
+                score += (lp[alphabet.get_idx(mut_aa)] - lp[alphabet.get_idx(sequence[pos])]).item()
+        scores.append(score)
+    
+    return scores
+
 def main():
     print("\n" + "="*70)
     print("  Stage 3: ESM-2 Zero-Shot Mutation Scoring")
@@ -111,18 +147,24 @@ def main():
     
     # Score each mutant
     print("\n[2/3] Scoring mutants...")
+    mutation_sets = [mutant['mutations'] for mutant in exp_data['experimental_mutants']]
+    if USE_ESM2:
+        # One batched model run for all mutants
+        print(f"  Using ESM-2 model {ESM2_MODEL}")
+        scores = score_with_esm2(wt_sequence, mutation_sets)
+    else:
+        # Mock implementation
+        scores = [score_with_esm2_mock(wt_sequence, mutations) for mutations in mutation_sets]
+    
     results = []
     
-    for mutant in exp_data['experimental_mutants']:
+    for mutant, score in zip(exp_data['experimental_mutants'], scores):
         print(f"\n  Mutant {mutant['id']}:")
         print(f"    Mutations: {', '.join(mutant['mutations'][:4])}...")
         
         # Apply mutations
         mut_sequence = apply_mutations(wt_sequence, mutant['mutations'])
         
-        # Score (mock implementation)
-        score = score_with_esm2_mock(wt_sequence, mutant['mutations'])
-        
         results.append({
             'mutant_id': mutant['id'],
             'mutations': mutant['mutations'],
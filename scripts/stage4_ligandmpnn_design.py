@@ -5,38 +5,24 @@ Simulates LigandMPNN design to validate critical mutations.
 """
 
 import json
-import numpy as np
-from pathlib import Path
 
-BASE_DIR = Path("/home/ubuntu/alars_validation")
-SEQUENCES_DIR = BASE_DIR / "sequences"
-RESULTS_DIR = BASE_DIR / "results"
+from pipeline_io import RESULTS_DIR, get_pdb_numbering_map, load_experimental_data, load_pdb_sequence, parse_mutation
 
-def load_experimental_data():
-    """Load experimental mutations"""
-    with open(SEQUENCES_DIR / "experimental_mutations.json", 'r') as f:
-        return json.load(f)
+# Active site residues considered when matching predictions (PDB numbering)
+ACTIVE_SITE_RESIDUES = frozenset((192, 193, 213, 215, 217, 249))
 
-def load_pdb_sequence():
-    """Load the PDB sequence for reference"""
-    with open(SEQUENCES_DIR / "pdb_sequence.txt", 'r') as f:
-        return f.read().strip()
-
-def get_pdb_numbering_map():
-    """
-    Returns a map from PDB residue number to 0-indexed sequence position.
-    Based on the analysis in Phase 1:
-    PDB 192: W (index 190)
-    PDB 193: A (index 191)
-    PDB 215: V (index 213)
-    PDB 217: M (index 215)
-    """
-    # This is a hardcoded map based on the PDB 2ZZF analysis
-    # In a real pipeline, this would be generated dynamically
-    pdb_map = {
-        192: 190, 193: 191, 213: 211, 215: 213, 217: 215, 249: 232, 360: 343, 459: 442
-    }
-    return pdb_map
+# Simulate the output of a LigandMPNN run
+# The output is a list of (PDB_RESIDUE_NUMBER, NEW_AA, SCORE)
+SIMULATED_LIGANDMPNN_OUTPUT = (
+    (215, 'G', 0.99),  # V215G is the most critical change
+    (192, 'H', 0.95),  # W192H is the second most critical
+    (193, 'G', 0.85),  # A193G is a good second shell choice
+    (217, 'I', 0.80),  # M217I is a good second shell choice
+    (213, 'A', 0.75),  # T213A is another good second shell choice
+    (249, 'F', 0.70),  # T249F is a good second shell choice
+    (192, 'F', 0.65),  # W192F is an alternative to W192H
+    (192, 'L', 0.60),  # W192L is another alternative
+)
 
 def simulate_ligandmpnn_design(exp_data, pdb_seq):
     """
@@ -53,30 +39,19 @@ def simulate_ligandmpnn_design(exp_data, pdb_seq):
         217: 'I',  # M217I: Second shell optimization
     }
     
-    # Simulate the output of a LigandMPNN run (top 5 predicted mutations)
-    # The output is a list of (PDB_RESIDUE_NUMBER, NEW_AA, SCORE)
-    simulated_output = [
-        (215, 'G', 0.99),  # V215G is the most critical change
-        (192, 'H', 0.95),  # W192H is the second most critical
-        (193, 'G', 0.85),  # A193G is a good second shell choice
-        (217, 'I', 0.80),  # M217I is a good second shell choice
-        (213, 'A', 0.75),  # T213A is another good second shell choice
-        (249, 'F', 0.70),  # T249F is a good second shell choice
-        (192, 'F', 0.65),  # W192F is an alternative to W192H
-        (192, 'L', 0.60),  # W192L is another alternative
-    ]
-    
-    # Filter to top 5 unique positions
+    # Filter to top 5 unique positions, best-scoring first; the best
+    # alternative at each position wins regardless of list order
     top_predictions = {}
-    for pos, aa, score in simulated_output:
+    for pos, aa, score in sorted(SIMULATED_LIGANDMPNN_OUTPUT, key=lambda t: -t[2]):
         if pos not in top_predictions:
             top_predictions[pos] = {'new_aa': aa, 'score': score}
-        if len(top_predictions) >= 5:
-            break
+            if len(top_predictions) == 5:
+                break
             
+    pdb_map = get_pdb_numbering_map()
     print("  ✓ Top 5 LigandMPNN Predictions (Simulated):")
     for pos, data in top_predictions.items():
-        print(f"    PDB {pos} ({pdb_seq[get_pdb_numbering_map()[pos]]} -> {data['new_aa']}): Score {data['score']:.2f}")
+        print(f"    PDB {pos} ({pdb_seq[pdb_map[pos]]} -> {data['new_aa']}): Score {data['score']:.2f}")
         
     return top_predictions
 
@@ -84,19 +59,20 @@ def validate_predictions(top_predictions, exp_data, pdb_seq):
     """Validates if the simulated LigandMPNN output matches experimental data"""
     print("\n[2/2] Validating against experimental data...")
     
-    exp_mutations = set()
-    for mutant in exp_data['experimental_mutants']:
-        # Only consider the active site mutations (192, 193, 213, 215, 217, 249)
-        for mut in mutant['mutations']:
-            pos = int(mut[1:-1])
-            if pos in [192, 193, 213, 215, 217, 249]:
-                exp_mutations.add(mut)
+    # Only consider the active site mutations (192, 193, 213, 215, 217, 249)
+    exp_mutations = {
+        mut
+        for mutant in exp_data['experimental_mutants']
+        for mut in mutant['mutations']
+        if parse_mutation(mut)[1] in ACTIVE_SITE_RESIDUES
+    }
     
     print(f"  Experimental Active Site Mutations: {sorted(list(exp_mutations))}")
     
+    pdb_map = get_pdb_numbering_map()
     match_count = 0
     for pos, data in top_predictions.items():
-        predicted_mut = f"{pdb_seq[get_pdb_numbering_map()[pos]]}{pos}{data['new_aa']}"
+        predicted_mut = f"{pdb_seq[pdb_map[pos]]}{pos}{data['new_aa']}"
         if predicted_mut in exp_mutations:
             print(f"  ✓ Match: {predicted_mut}")
             match_count += 1
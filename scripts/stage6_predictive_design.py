@@ -4,131 +4,247 @@ Stage 6: Predictive Design for Novel Mutants
 Generates novel mutant candidates using a combined LigandMPNN/ESM-2 scoring function.
 """
 
-import json
-import random
-import statistics
-from pathlib import Path
+import functools
+import numpy as np
+from collections.abc import Iterable
 
-BASE_DIR = Path("/home/ubuntu/alars_validation")
-RESULTS_DIR = BASE_DIR / "results"
-SEQUENCES_DIR = BASE_DIR / "sequences"
+from pipeline_io import RESULTS_DIR, get_pdb_numbering_map, load_pdb_sequence, parse_mutation, write_json
 
 # --- Constants based on previous analysis ---
-# PDB numbering to 0-indexed sequence position (from PDB 2ZZG analysis)
-PDB_MAP = {
-    192: 190, 193: 191, 213: 211, 215: 213, 217: 215, 249: 232, 360: 343, 459: 442
-}
+# (PDB numbering map: pipeline_io.get_pdb_numbering_map)
 
 # Critical active site residues (PDB numbering)
 ACTIVE_SITE_RESIDUES = [192, 193, 213, 215, 217, 249]
 
+# Random seed of the search. Sampling and then the ensemble noise are drawn
+# in turn from RNG (PCG64), so repeated runs produce the same candidates;
+# change it to explore a different sample.
+SEED = 42
+RNG = np.random.Generator(np.random.PCG64(SEED))
+
 # Amino acids to sample (excluding Proline for structural reasons, and Cysteine for stability)
 AMINO_ACIDS = "ADEFGHIKLMNQRSTVWY"
 
+# Sampling pools: active site residues other than the fixed V215, and the
+# amino acids available as a replacement for each wild-type residue
+SAMPLE_POSITIONS = tuple(r for r in ACTIVE_SITE_RESIDUES if r != 215)
+AA_POOL_EXCLUDING_WT = {aa: tuple(a for a in AMINO_ACIDS if a != aa) for aa in AMINO_ACIDS}
+
+# Packed mutation codes: (index in ACTIVE_SITE_RESIDUES << AA_BITS) | index in
+# AMINO_ACIDS. Candidates are rows of codes, padded with NO_MUTATION.
+AA_BITS = 5
+NO_MUTATION = -1
+CODE_DTYPE = np.int16  # largest code is (5 << AA_BITS) | 17 = 177, too big for int8
+
+def encode_mutation(site_idx, aa_idx):
+    """Pack an active-site index and an amino-acid index into one int code"""
+    return (site_idx << AA_BITS) | aa_idx
+
+@functools.lru_cache(maxsize=1)
+def get_wt_residues():
+    """Wild-type amino acid at each active site residue, keyed by PDB number"""
+    pdb_seq = load_pdb_sequence()
+    pdb_map = get_pdb_numbering_map()
+    return {pos: pdb_seq[pdb_map[pos]] for pos in ACTIVE_SITE_RESIDUES}
+
+def decode_mutations(codes, wt_aa_at):
+    """'V215G'-style labels for one candidate row of packed codes, in row order"""
+    labels = []
+    for code in codes:
+        if code == NO_MUTATION:
+            continue
+        pos = ACTIVE_SITE_RESIDUES[code >> AA_BITS]
+        labels.append(f"{wt_aa_at[pos]}{pos}{AMINO_ACIDS[code & ((1 << AA_BITS) - 1)]}")
+    return labels
+
+# Reward-bearing mutations: W192 variants and second-shell mutations (A193G/L, M217I, T213A, T249F)
+W192_TARGETS = frozenset({'W192H', 'W192F', 'W192Y', 'W192L'})
+SECOND_SHELL = frozenset({'A193G', 'A193L', 'M217I', 'T213A', 'T249F'})
+
+# One bit per reward-bearing mutation, and the masks of each reward group
+REWARD_BITS = {mut: 1 << bit for bit, mut in enumerate(['V215G', *sorted(W192_TARGETS), *sorted(SECOND_SHELL)])}
+V215G_MASK = REWARD_BITS['V215G']
+W192_MASK = sum(REWARD_BITS[mut] for mut in W192_TARGETS)
+SECOND_SHELL_MASK = sum(REWARD_BITS[mut] for mut in SECOND_SHELL)
+
 # --- Scoring Function (Deterministic Simulation) ---
-def get_base_score(mutations):
+def get_base_score(mutations: Iterable[str]) -> float:
     """
     Simulates a deterministic base score based on structural principles (LigandMPNN).
+    Scores are memoized per distinct mutation set.
     """
-    score = 0.0
-    
-    # 1. LigandMPNN Component (Structural Necessity)
-    # V215G is the most critical structural change (high reward)
-    if 'V215G' in mutations:
-        score += 5.0
+    return _base_score(frozenset(mutations))
+
+@functools.lru_cache(maxsize=4096)
+def _base_score(mutations):
+    """get_base_score for a frozenset of mutation labels"""
+    mask = 0
+    for mut in mutations:
+        mask |= REWARD_BITS.get(mut, 0)
     
-    # W192 is the second most critical (moderate reward for specific changes)
-    w192_mut = next((m for m in mutations if m.endswith('192H') or m.endswith('192F') or m.endswith('192Y') or m.endswith('192L')), None)
-    if w192_mut:
-        score += 3.0
-        
-    # Reward for second-shell mutations (A193G/L, M217I, T213A, T249F)
-    second_shell_muts = ['A193G', 'A193L', 'M217I', 'T213A', 'T249F']
-    for mut in second_shell_muts:
-        if mut in mutations:
-            score += 0.5
+    # 1. LigandMPNN Component (Structural Necessity), one term per reward group:
+    # V215G is the most critical structural change (high reward),
+    # W192 is the second most critical (moderate reward for specific changes),
+    # and each second-shell mutation adds a small reward
+    score = (5.0 * bool(mask & V215G_MASK)
+             + 3.0 * bool(mask & W192_MASK)
+             + 0.5 * (mask & SECOND_SHELL_MASK).bit_count())
             
     # Penalty for too many mutations (Simulate stability loss)
     score -= (len(mutations) - 6) * 0.2
     
     return max(0.0, score)
 
-def get_ensemble_score(mutations, num_folds=5, seed=42):
+def _mutation_reward(mut):
+    """Per-mutation term of get_base_score (used to build reward lookup tables)"""
+    if mut == 'V215G':
+        return 5.0
+    if mut in W192_TARGETS:
+        return 3.0
+    if mut in SECOND_SHELL:
+        return 0.5
+    return 0.0
+
+def score_all_ensemble(base_scores, num_folds=5, seed=SEED):
+    """
+    Simulates ensemble (cross-validation) scores for a batch of candidates.
+    Each candidate gets its own simulated ESM-2 noise per fold, drawn in one
+    batch from a generator seeded with `seed` (an int or a np.random.Generator).
+    Returns the per-candidate mean and standard deviation over the folds.
+    """
+    base_scores = np.asarray(base_scores, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    
+    # Simulate ESM-2 noise (evolutionary fitness uncertainty)
+    noise = rng.uniform(-0.5, 0.5, size=(len(base_scores), num_folds))
+    fold_scores = base_scores[:, None] + noise
+    
+    avg_scores = fold_scores.mean(axis=1)
+    std_devs = fold_scores.std(axis=1, ddof=1) if num_folds > 1 else np.zeros(len(base_scores))
+    
+    return avg_scores, std_devs
+
+def get_ensemble_score(mutations: Iterable[str], num_folds: int = 5, seed: int = SEED,
+                       base_score: float | None = None) -> tuple[float, float]:
     """
     Simulates an ensemble (cross-validation) score for robustness.
     The base score is deterministic, the ESM-2 component is simulated with noise.
+    A precomputed base score may be passed in to skip get_base_score.
+    """
+    if base_score is None:
+        base_score = get_base_score(mutations)
+    avg_scores, std_devs = score_all_ensemble([base_score], num_folds, seed)
+    return float(avg_scores[0]), float(std_devs[0])
+
+# --- Search Algorithm ---
+def _sample_candidates(rng, codes, base_scores, pool_codes, reward_lut, num_additional_range):
+    """
+    Sample all candidates in place: `codes` rows already hold the fixed
+    mutations and are padded with NO_MUTATION; the sampled mutations and
+    the resulting base scores are written into the preallocated arrays.
     """
-    base_score = get_base_score(mutations)
-    fold_scores = []
+    num_candidates = len(codes)
+    num_fixed = codes.shape[1] - len(SAMPLE_POSITIONS)
     
-    # Use a fixed seed for the overall process, but let the fold-specific noise vary
-    random.seed(seed)
+    # Number of additional mutations per candidate, uniform over the range
+    num_additional = rng.integers(num_additional_range[0], num_additional_range[1] + 1, size=num_candidates)
+    max_muts = int(num_additional.max(initial=0))
+    active = np.arange(max_muts) < num_additional[:, None]
     
-    for i in range(num_folds):
-        # Simulate ESM-2 noise (evolutionary fitness uncertainty)
-        # The noise is deterministic for a given fold (i) and the overall seed
-        random.seed(seed + i)
-        esm2_noise = random.uniform(-0.5, 0.5)
-        
-        fold_score = base_score + esm2_noise
-        fold_scores.append(fold_score)
-        
-    avg_score = statistics.mean(fold_scores)
-    std_dev = statistics.stdev(fold_scores) if len(fold_scores) > 1 else 0.0
+    # Sample distinct positions without rejection: an independent shuffle of
+    # the position pool per candidate, truncated to its mutation count
+    pool = np.broadcast_to(np.arange(len(SAMPLE_POSITIONS)), (num_candidates, len(SAMPLE_POSITIONS)))
+    pos_idx = rng.permuted(pool, axis=1)[:, :max_muts]
+    
+    # Sample new amino acids from the pool excluding each position's wild-type
+    aa_idx = rng.integers(0, len(AMINO_ACIDS) - 1, size=(num_candidates, max_muts))
+    codes[:, num_fixed:num_fixed + max_muts] = np.where(active, pool_codes[pos_idx, aa_idx], NO_MUTATION)
     
-    return avg_score, std_dev
+    # Base scores: one reward gather per code, then the mutation-count penalty
+    is_mutation = codes != NO_MUTATION
+    rewards = np.where(is_mutation, reward_lut[codes], 0.0)
+    base_scores[:] = np.maximum(rewards.sum(axis=1) - (is_mutation.sum(axis=1) - 6) * 0.2, 0.0)
 
-# --- Search Algorithm ---
-def generate_novel_mutants(num_candidates=1000, num_mutations_range=(5, 8)):
+def generate_novel_mutants(num_candidates: int = 1000, num_mutations_range: tuple[int, int] = (5, 8),
+                           rng: np.random.Generator | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     Generates a set of novel mutant candidates by sampling the mutation space.
+    Positions and amino acids for all candidates are drawn in NumPy batches
+    from `rng` (the module RNG by default), which then continues to supply
+    the ensemble noise. Each candidate mutates a given
+    position at most once, so `num_mutations_range` (inclusive, counting
+    the fixed V215G) is capped at 1 + len(SAMPLE_POSITIONS) = 6 mutations.
+    Returns the (candidates x mutations) matrix of packed mutation codes and
+    the ensemble average scores and standard deviations.
     """
+    if rng is None:
+        rng = RNG
     
-    # Load wild-type sequence (for reference, not used in scoring simulation)
-    with open(SEQUENCES_DIR / "pdb_sequence.txt", 'r') as f:
-        pdb_seq = f.read().strip()
-        
-    novel_mutants = []
+    # Wild-type residues (label the wild-type side of each mutation)
+    wt_aa_at = get_wt_residues()
     
     # Ensure the core V215G is always present in the high-yield search
     fixed_mutations = ['V215G']
+    fixed_codes = []
+    for mut in fixed_mutations:
+        _, pos, new_aa = parse_mutation(mut)
+        fixed_codes.append(encode_mutation(ACTIVE_SITE_RESIDUES.index(pos), AMINO_ACIDS.index(new_aa)))
     
-    for i in range(num_candidates):
-        # Start with the fixed, essential mutation
-        mutations = set(fixed_mutations)
-        
-        # Determine the number of additional mutations to sample
-        num_additional_muts = random.randint(num_mutations_range[0] - len(fixed_mutations), num_mutations_range[1] - len(fixed_mutations))
-        
-        # Sample additional mutations
-        while len(mutations) < num_additional_muts + len(fixed_mutations):
-            # Select a random active site residue (excluding V215)
-            pos = random.choice([r for r in ACTIVE_SITE_RESIDUES if r != 215])
-            
-            # Select a random new amino acid (excluding the wild-type)
-            wt_aa = pdb_seq[PDB_MAP[pos]]
-            new_aa = random.choice([aa for aa in AMINO_ACIDS if aa != wt_aa])
-            
-            mut = f"{wt_aa}{pos}{new_aa}"
-            
-            # Ensure no conflicting mutations at the same position
-            if not any(m.endswith(str(pos)) for m in mutations):
-                mutations.add(mut)
-        
-        # Convert set to list and sort for consistency
-        mutations_list = sorted(list(mutations))
-        
-        # Score the mutant using the robust ensemble method
-        avg_score, std_dev = get_ensemble_score(mutations_list)
-        
-        novel_mutants.append({
-            'mutant_id': f"novel_mutant_{i+1}",
-            'mutations': mutations_list,
-            'avg_score': avg_score,
-            'std_dev': std_dev
-        })
-        
-    return novel_mutants
+    # Label and reward of every packed code (same terms as get_base_score),
+    # and each code's rank in label order
+    code_labels = [""] * (len(ACTIVE_SITE_RESIDUES) << AA_BITS)
+    for site_idx, pos in enumerate(ACTIVE_SITE_RESIDUES):
+        for aa_idx, aa in enumerate(AMINO_ACIDS):
+            code_labels[encode_mutation(site_idx, aa_idx)] = f"{wt_aa_at[pos]}{pos}{aa}"
+    reward_lut = np.array([_mutation_reward(label) for label in code_labels])
+    label_rank = np.argsort(np.argsort(code_labels, kind='stable'), kind='stable')
+    
+    # Codes per sampled position x non-wild-type amino acid
+    pool_codes = np.array([[encode_mutation(ACTIVE_SITE_RESIDUES.index(pos), AMINO_ACIDS.index(aa))
+                            for aa in AA_POOL_EXCLUDING_WT[wt_aa_at[pos]]]
+                           for pos in SAMPLE_POSITIONS], dtype=CODE_DTYPE)
+    
+    # Additional mutations per candidate: at most one per sampled position
+    num_additional_range = (num_mutations_range[0] - len(fixed_mutations),
+                            min(num_mutations_range[1] - len(fixed_mutations), len(SAMPLE_POSITIONS)))
+    if num_additional_range[0] > len(SAMPLE_POSITIONS):
+        raise ValueError(f"num_mutations_range {num_mutations_range} needs more than "
+                         f"{len(fixed_mutations) + len(SAMPLE_POSITIONS)} mutations per candidate")
+    
+    # Preallocated outputs: one row of packed codes per candidate (fixed
+    # mutations, then room for one mutation per sampled position)
+    codes = np.full((num_candidates, len(fixed_codes) + len(SAMPLE_POSITIONS)), NO_MUTATION, dtype=CODE_DTYPE)
+    codes[:, :len(fixed_codes)] = fixed_codes
+    base_scores = np.empty(num_candidates)
+    
+    _sample_candidates(rng, codes, base_scores, pool_codes, reward_lut, num_additional_range)
+    
+    # Sort every candidate's mutations once, on the integer codes: rows are
+    # ordered as their labels sort, with the NO_MUTATION padding first
+    sort_keys = np.where(codes == NO_MUTATION, -1, label_rank[codes])
+    codes = np.take_along_axis(codes, np.argsort(sort_keys, axis=1), axis=1)
+    
+    # Score every mutant using the robust ensemble method; the noise comes
+    # from the same stream, after the sampling draws, so it is independent
+    # of them (a fresh SEED generator would replay the sampling bits)
+    avg_scores, std_devs = score_all_ensemble(base_scores, seed=rng)
+    
+    return codes, avg_scores, std_devs
+
+def select_top_candidates(avg_scores, std_devs, k=10):
+    """
+    Indices of the k best candidates: highest average score first, ties
+    broken by lowest standard deviation. Only candidates scoring at least
+    the k-th best average (found with argpartition) are sorted.
+    """
+    k = min(k, len(avg_scores))
+    if k == 0:
+        return np.zeros(0, dtype=np.intp)
+    
+    kth_score = np.partition(avg_scores, len(avg_scores) - k)[len(avg_scores) - k]
+    shortlist = np.flatnonzero(avg_scores >= kth_score)
+    order = np.lexsort((std_devs[shortlist], -avg_scores[shortlist]))
+    return shortlist[order[:k]]
 
 def main():
     print("\n" + "="*70)
@@ -136,22 +252,28 @@ def main():
     print("="*70 + "\n")
     
     # 1. Generate and score novel mutants
-    novel_mutants = generate_novel_mutants(num_candidates=5000)
+    codes, avg_scores, std_devs = generate_novel_mutants(num_candidates=5000)
     
     # 2. Filter and select the top 10 candidates
     # Primary sort key: highest average score
     # Secondary sort key: lowest standard deviation (most robust/reliable)
-    novel_mutants.sort(key=lambda x: (x['avg_score'], -x['std_dev']), reverse=True)
-    top_candidates = novel_mutants[:10]
+    top_idx = select_top_candidates(avg_scores, std_devs, k=10)
+    
+    # Only the winners are decoded back to mutation labels
+    wt_aa_at = get_wt_residues()
+    top_candidates = [{
+        'mutant_id': f"novel_mutant_{i+1}",
+        'mutations': decode_mutations(codes[i].tolist(), wt_aa_at),
+        'avg_score': float(avg_scores[i]),
+        'std_dev': float(std_devs[i])
+    } for i in top_idx.tolist()]
     
     # 3. Save the top candidates
     RESULTS_DIR.mkdir(parents=True, exist_ok=True)
     output_file = RESULTS_DIR / "top_novel_mutants.json"
-    
-    with open(output_file, 'w') as f:
-        json.dump(top_candidates, f, indent=2)
+    write_json(output_file, top_candidates)
         
-    print(f"  ✓ Generated {len(novel_mutants)} candidates.")
+    print(f"  ✓ Generated {len(codes)} candidates.")
     print(f"  ✓ Selected top 10 candidates based on combined score.")
     print(f"  ✓ Saved to: {output_file}")
     